@@ -1,20 +1,38 @@
 # server.py  (cleaned, header-repair enabled)
 # Usage:
-#   pip install flask pandas scikit-learn joblib python-dateutil
+#   pip install flask pandas scikit-learn joblib python-dateutil orjson
 #   python server.py
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response
+from flask.json.provider import JSONProvider
 from pathlib import Path
 import joblib, pandas as pd, numpy as np, time, json, csv, traceback, os
-from collections import defaultdict
 from datetime import datetime, timedelta
 import threading
+import functools
+import itertools
 from queue import Queue, Empty
+import orjson
+from sklearn.preprocessing import StandardScaler
 
 # optional (fallback) parser
 from dateutil import parser as dateparser
 
+# orjson for all (de)serialization; numpy scalars/arrays are encoded natively
+ORJSON_OPTS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=ORJSON_OPTS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+def orjson_response(obj, status=200):
+    return Response(orjson.dumps(obj, option=ORJSON_OPTS), status=status, mimetype="application/json")
+
 APP = Flask(__name__)
+APP.json = OrjsonProvider(APP)
 BASE = Path(__file__).parent.resolve()
 
 # ---------- Config ----------
@@ -54,6 +72,28 @@ if not MODEL_PATH.exists() or not SCALER_PATH.exists():
 model = joblib.load(MODEL_PATH)
 scaler = joblib.load(SCALER_PATH)
 
+# no intra-request parallelism by default (it fights concurrent HTTP requests);
+# n_jobs=None lets a thread-local joblib.parallel_config() raise it for big batches
+PARALLEL_PREDICT_MIN_ROWS = 256
+if hasattr(model, "n_jobs"):
+    model.n_jobs = None
+
+# StandardScaler is just (x - mean_) / scale_; doing it inline skips sklearn's per-call validation.
+# Same float64 ops in the same order as transform(), honouring with_mean / with_std; anything
+# that is not a plain StandardScaler keeps going through transform().
+if type(scaler) is StandardScaler and hasattr(scaler, "scale_"):
+    _SCALER_MEAN = (np.array(scaler.mean_, dtype=np.float64)
+                    if scaler.with_mean and scaler.mean_ is not None else 0.0)
+    _SCALER_SCALE = (np.array(scaler.scale_, dtype=np.float64)
+                     if scaler.with_std and scaler.scale_ is not None else 1.0)
+else:
+    _SCALER_MEAN = _SCALER_SCALE = None
+
+def scale_features(X):
+    if _SCALER_MEAN is None:
+        return scaler.transform(X)
+    return (X - _SCALER_MEAN) / _SCALER_SCALE
+
 # ---------- Feature order (load or derive) ----------
 def load_feature_order():
     if FEATURE_ORDER_JSON.exists():
@@ -72,6 +112,8 @@ if 'req_count_same_sec' not in feature_order:
     feature_order.append('req_count_same_sec')
 
 FEATURE_ORDER = feature_order
+FEATURE_ORDER_TUPLE = tuple(FEATURE_ORDER)
+RC_IDX = FEATURE_ORDER.index('req_count_same_sec')
 
 # CSV log header (features + raw timestamp + metadata)
 CSV_HEADER = FEATURE_ORDER + ["raw_timestamp", "predicted_label", "predicted_label_idx", "confidence", "pred_time_unix", "pred_time_human"]
@@ -135,8 +177,8 @@ def ensure_csv_has_headers(csv_path: Path, extra_headers, csv_header):
 ensure_csv_has_headers(CSV_LOG, EXTRA_HEADERS, CSV_HEADER)
 
 # ---------- Thread-safe counters + writer queue ----------
-req_counter = defaultdict(int)
-req_lock = threading.Lock()
+# (device_id, ts_second) -> itertools.count; next() on a count is atomic under the GIL
+req_counter = {}
 write_queue = Queue()
 REQ_COUNTER_CLEANUP_SECONDS = 300
 
@@ -147,14 +189,18 @@ def parse_timestamp_to_second(ts_value):
     s = str(ts_value).strip()
     if not s:
         return None
+    return _parse_ts_cached(s)
+
+# devices reporting around the same wall-clock time repeat the same strings; keep this pure
+@functools.lru_cache(maxsize=4096)
+def _parse_ts_cached(s):
+    # already canonical (YYYY-MM-DDTHH:MM:SS...) -> just truncate, no datetime needed
+    if len(s) >= 19 and s[4] == '-' and s[7] == '-' and s[10] in ('T', ' ') and s[13] == ':' and s[16] == ':':
+        if (s[:4] + s[5:7] + s[8:10] + s[11:13] + s[14:16] + s[17:19]).isdigit():
+            return s[:10] + 'T' + s[11:19]
     try:
-        if len(s) >= 19 and s[4] == '-' and s[7] == '-' and s[10] in ('T', ' '):
-            if s.endswith('Z'):
-                dt = datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ")
-                return dt.strftime("%Y-%m-%dT%H:%M:%S")
-            else:
-                dt = datetime.strptime(s[:19], "%Y-%m-%dT%H:%M:%S")
-                return dt.strftime("%Y-%m-%dT%H:%M:%S")
+        dt = datetime.fromisoformat(s.replace('Z', '+00:00'))
+        return dt.strftime("%Y-%m-%dT%H:%M:%S")
     except Exception:
         pass
     try:
@@ -171,9 +217,8 @@ def get_req_count_and_increment(device_id, ts_value):
         key = (str(device_id), "__unknown__")
     else:
         key = (str(device_id), ts_sec)
-    with req_lock:
-        req_counter[key] += 1
-        return req_counter[key]
+    # setdefault + next are both single C calls, so no lock is needed on the hot path
+    return next(req_counter.setdefault(key, itertools.count(1)))
 
 def req_counter_cleanup_loop():
     while True:
@@ -182,23 +227,32 @@ def req_counter_cleanup_loop():
         for i in range(0, REQ_COUNTER_CLEANUP_SECONDS, max(1, REQ_COUNTER_CLEANUP_SECONDS // 10)):
             t = (datetime.utcnow() - timedelta(seconds=i)).strftime("%Y-%m-%dT%H:%M:%S")
             allowed_prefixes.add(t[:19])
-        with req_lock:
-            keys_to_remove = [k for k in req_counter.keys() if (k[1] != "__unknown__" and k[1] not in allowed_prefixes)]
-            for k in keys_to_remove:
-                del req_counter[k]
+        keys_to_remove = [k for k in list(req_counter) if (k[1] != "__unknown__" and k[1] not in allowed_prefixes)]
+        for k in keys_to_remove:
+            req_counter.pop(k, None)
 
 cleanup_thread = threading.Thread(target=req_counter_cleanup_loop, daemon=True)
 cleanup_thread.start()
 
 # ---------- Background CSV writer (robust) ----------
+CSV_WRITE_BATCH_MAX = 1024
+
+def _csv_handle_stale(fh):
+    # file was rotated / replaced (e.g. by the header repair) since we opened it
+    try:
+        return os.stat(CSV_LOG).st_ino != os.fstat(fh.fileno()).st_ino
+    except OSError:
+        return True
+
 def csv_writer_loop():
-    import csv as _csv
+    import csv as _csv, io
+    fh = None
     while True:
         batch = []
         try:
             item = write_queue.get(timeout=1.0)
             batch.append(item)
-            while True:
+            while len(batch) < CSV_WRITE_BATCH_MAX:
                 try:
                     item = write_queue.get_nowait()
                     batch.append(item)
@@ -208,17 +262,30 @@ def csv_writer_loop():
             continue
 
         try:
-            ensure_csv_has_headers(CSV_LOG, EXTRA_HEADERS, CSV_HEADER)
-
-            with open(CSV_LOG, "a", newline="") as f:
-                writer = _csv.writer(f)
-                for feature_log_dict, result in batch:
-                    t_unix = time.time()
-                    t_human = datetime.fromtimestamp(t_unix).strftime("%Y-%m-%d %H:%M:%S")
-                    row = [ feature_log_dict.get(col, 0) for col in FEATURE_ORDER ]
-                    raw_ts = feature_log_dict.get('raw_timestamp', None)
-                    row += [ raw_ts, result.get("label"), result.get("label_idx"), result.get("confidence"), t_unix, t_human ]
-                    writer.writerow(row)
+            # headers were ensured at import; only re-check when the file was rotated/replaced
+            if fh is None or _csv_handle_stale(fh):
+                if fh is not None:
+                    fh.close()
+                    ensure_csv_has_headers(CSV_LOG, EXTRA_HEADERS, CSV_HEADER)
+                fh = open(CSV_LOG, "a", newline="")
+
+            # format the whole batch in memory, then hand it to the file in one write
+            # timestamps are the prediction times captured at enqueue, not the flush time
+            sio = io.StringIO()
+            rows = []
+            for feature_log_dict, result, t_unix in batch:
+                t_human = datetime.fromtimestamp(t_unix).strftime("%Y-%m-%d %H:%M:%S")
+                row = [ feature_log_dict.get(col, 0) for col in FEATURE_ORDER ]
+                raw_ts = feature_log_dict.get('raw_timestamp', None)
+                row += [ raw_ts, result.get("label"), result.get("label_idx"), result.get("confidence"), t_unix, t_human ]
+                rows.append(row)
+            _csv.writer(sio).writerows(rows)
+            fh.write(sio.getvalue())
+            fh.flush()
+
+            # audit trail: same JSON lines as before, but off the request path and in one write
+            with open(PRED_LOG, "a") as lf:
+                lf.write("".join(json.dumps({"time": t, "input": d, "result": r}) + "\n" for d, r, t in batch))
         except Exception as e:
             with open(PRED_LOG, "a") as lf:
                 lf.write(f"CSV writer error: {e}\n")
@@ -233,102 +300,94 @@ def sanitize_input_keys(d: dict):
         out['req_count_same_sec'] = out.get('req_count')
     return out
 
+def _to_float(v):
+    if isinstance(v, (int, float)):
+        return float(v)
+    try:
+        return float(v)
+    except Exception:
+        return 0.0
+
 def build_feature_vector_from_input(input_dict):
     input_dict = sanitize_input_keys(input_dict or {})
-    feat = {}
-    for f in FEATURE_ORDER:
-        if f == 'req_count_same_sec':
-            continue
-        feat[f] = input_dict.get(f, None)
 
     device_id_raw = input_dict.get("device_id", "unknown_device")
     raw_ts = input_dict.get("timestamp", None)
 
     rc_val = None
-    if 'req_count_same_sec' in input_dict and input_dict.get('req_count_same_sec') not in (None, ""):
+    rc_raw = input_dict.get('req_count_same_sec')
+    if rc_raw not in (None, ""):
         try:
-            rc_val = int(float(input_dict.get('req_count_same_sec')))
+            rc_val = int(float(rc_raw))
         except Exception:
             rc_val = None
 
     if rc_val is None:
         rc_val = get_req_count_and_increment(device_id_raw, raw_ts)
 
-    feat['req_count_same_sec'] = rc_val
-
-    vec = []
-    for f in FEATURE_ORDER:
-        v = feat.get(f, None)
-        if v is None:
-            v = input_dict.get(f, 0)
-        try:
-            vec.append(float(v))
-        except Exception:
-            vec.append(0.0)
+    vec = np.empty(len(FEATURE_ORDER_TUPLE))
+    log_dict = {}
+    for i, f in enumerate(FEATURE_ORDER_TUPLE):
+        v = input_dict.get(f)
+        log_dict[f] = v
+        vec[i] = 0.0 if v is None else _to_float(v)
+    vec[RC_IDX] = rc_val
+    if log_dict['req_count_same_sec'] is None:
+        log_dict['req_count_same_sec'] = rc_val
 
-    log_dict = { k: (input_dict.get(k) if input_dict.get(k) is not None else feat.get(k, 0)) for k in FEATURE_ORDER }
     log_dict['raw_timestamp'] = raw_ts
-    return np.array(vec, dtype=float), log_dict
+    return vec, log_dict
 
-def predict_from_vector(vec):
-    X = vec.reshape(1, -1)
+def predict_from_matrix(X):
+    # one scaler/model call for all rows; per-row Python work is only building the dicts
     try:
-        Xs = scaler.transform(X)
+        Xs = scale_features(X)
     except Exception as e:
         raise RuntimeError(f"Scaler transform failed: {e}")
 
     probs = None
     if hasattr(model, "predict_proba"):
         try:
-            probs = model.predict_proba(Xs)[0]
+            if len(X) >= PARALLEL_PREDICT_MIN_ROWS:
+                with joblib.parallel_config(n_jobs=-1):
+                    probs = model.predict_proba(Xs)
+            else:
+                probs = model.predict_proba(Xs)
         except Exception:
             probs = None
 
-    raw_pred = model.predict(Xs)[0]
-    label_idx = None
-    try:
-        label_idx = int(raw_pred)
-    except Exception:
-        label_idx = None
-
     # ---------- Threshold logic ----------
-    attack_prob = None
-    if probs is not None and len(probs) >= 2:
-        attack_prob = float(probs[1])
-        normal_prob = float(probs[0])
-    else:
-        attack_prob = 0.0
-        normal_prob = 1.0
-
-    if attack_prob >= 0.987:
-        final_label = "1"
-        final_label_idx = 1
+    if probs is not None and probs.shape[1] >= 2:
+        attack_prob = probs[:, 1]
+        normal_prob = probs[:, 0]
     else:
-        final_label = "0"
-        final_label_idx = 0
+        attack_prob = np.zeros(len(X))
+        normal_prob = np.ones(len(X))
 
-    confidence = max(normal_prob, attack_prob)
+    label_idx = np.where(attack_prob >= 0.987, 1, 0)
+    confidence = np.maximum(normal_prob, attack_prob)
     probs_list = probs.tolist() if probs is not None else None
 
-    return {
-        "label": final_label,
-        "label_idx": final_label_idx,
-        "probs": probs_list,
-        "confidence": confidence
-    }
+    return [
+        {
+            "label": str(int(label_idx[i])),
+            "label_idx": int(label_idx[i]),
+            "probs": probs_list[i] if probs_list is not None else None,
+            "confidence": float(confidence[i])
+        }
+        for i in range(len(X))
+    ]
+
+def predict_from_vector(vec):
+    return predict_from_matrix(vec.reshape(1, -1))[0]
 
 def append_row_to_csv_and_log(feature_log_dict, result):
+    pred_time = time.time()
     try:
-        write_queue.put_nowait((feature_log_dict, result))
+        write_queue.put_nowait((feature_log_dict, result, pred_time))
     except Exception:
         with open(PRED_LOG, "a") as f:
-            f.write(json.dumps({"time": time.time(), "input": feature_log_dict, "result": result}) + "\n")
-
-    try:
-        with open(PRED_LOG, "a") as f:
-            f.write(json.dumps({"time": time.time(), "input": feature_log_dict, "result": result}) + "\n")
-    except:
-        pass
+            f.write(json.dumps({"time": pred_time, "input": feature_log_dict, "result": result}) + "\n")
 
 # ---------- Routes ----------
 @APP.route("/health", methods=["GET"])
@@ -339,12 +398,14 @@ def health():
             info["model_n_features_in"] = int(model.n_features_in_)
     except Exception:
         pass
+    ci = _parse_ts_cached.cache_info()
+    info["ts_cache"] = {"hits": ci.hits, "misses": ci.misses, "size": ci.currsize, "maxsize": ci.maxsize}
     return jsonify(info)
 
 @APP.route("/predict", methods=["POST"])
 def predict_single():
     try:
-        payload = request.get_json(force=True)
+        payload = orjson.loads(request.get_data())
         if isinstance(payload, dict) and "features" in payload:
             input_data = payload["features"]
         else:
@@ -354,42 +415,51 @@ def predict_single():
         res = predict_from_vector(vec)
         res["uncertain"] = (res["confidence"] is not None and res["confidence"] < 0.4)
         append_row_to_csv_and_log(logdict, res)
-        return jsonify(res)
+        return orjson_response(res)
     except Exception as e:
         traceback.print_exc()
-        return jsonify({"error": str(e)}), 400
+        return orjson_response({"error": str(e)}, 400)
+
+def predict_rows(rows):
+    if not rows:
+        return []
+    # float64 to match what the scaler was fitted on (float32 flips borderline tree splits)
+    X = np.empty((len(rows), len(FEATURE_ORDER)), dtype=np.float64)
+    logdicts = []
+    for i, input_data in enumerate(rows):
+        vec, logdict = build_feature_vector_from_input(sanitize_input_keys(input_data))
+        X[i] = vec
+        logdicts.append(logdict)
+
+    outputs = []
+    for logdict, res in zip(logdicts, predict_from_matrix(X)):
+        res["uncertain"] = (res["confidence"] is not None and res["confidence"] < 0.4)
+        append_row_to_csv_and_log(logdict, res)
+        outputs.append({"input": logdict, "result": res})
+    return outputs
 
 @APP.route("/batch_predict", methods=["POST"])
 def predict_batch():
     try:
-        outputs = []
         if request.files and "file" in request.files:
             f = request.files["file"]
             df_in = pd.read_csv(f, engine='python')
-            for _, r in df_in.iterrows():
-                input_data = r.to_dict()
-                input_data = sanitize_input_keys(input_data)
-                vec, logdict = build_feature_vector_from_input(input_data)
-                res = predict_from_vector(vec)
-                res["uncertain"] = (res["confidence"] is not None and res["confidence"] < 0.4)
-                append_row_to_csv_and_log(logdict, res)
-                outputs.append({"input": logdict, "result": res})
-            return jsonify({"count": len(outputs), "predictions": outputs})
-        payload = request.get_json(force=True)
+            outputs = predict_rows(df_in.to_dict(orient="records"))
+            return orjson_response({"count": len(outputs), "predictions": outputs})
+        payload = orjson.loads(request.get_data())
         if isinstance(payload, list):
-            for item in payload:
-                input_data = item.get("features", item) if isinstance(item, dict) else {}
-                input_data = sanitize_input_keys(input_data)
-                vec, logdict = build_feature_vector_from_input(input_data)
-                res = predict_from_vector(vec)
-                res["uncertain"] = (res["confidence"] is not None and res["confidence"] < 0.4)
-                append_row_to_csv_and_log(logdict, res)
-                outputs.append({"input": logdict, "result": res})
-            return jsonify({"count": len(outputs), "predictions": outputs})
-        return jsonify({"error": "Unsupported payload for batch_predict. Send multipart CSV (file) or JSON list."}), 400
+            rows = [ (item.get("features", item) if isinstance(item, dict) else {}) for item in payload ]
+            outputs = predict_rows(rows)
+            return orjson_response({"count": len(outputs), "predictions": outputs})
+        # compact form {"features": [ {...}, ... ]} -> labels only, in input order
+        if isinstance(payload, dict) and isinstance(payload.get("features"), list):
+            rows = [ (item if isinstance(item, dict) else {}) for item in payload["features"] ]
+            outputs = predict_rows(rows)
+            return orjson_response({"count": len(outputs), "labels": [o["result"]["label"] for o in outputs]})
+        return orjson_response({"error": "Unsupported payload for batch_predict. Send multipart CSV (file), JSON list, or {\"features\": [...]}."}, 400)
     except Exception as e:
         traceback.print_exc()
-        return jsonify({"error": str(e)}), 400
+        return orjson_response({"error": str(e)}, 400)
 
 @APP.route("/download_logs", methods=["GET"])
 def download_logs():
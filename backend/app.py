@@ -1,42 +1,157 @@
-from flask import Flask, jsonify, request
+# backend/app.py
+# Usage:
+#   pip install -r requirements.txt
+#   python app.py                       (development)
+#   gunicorn -k geventwebsocket.gunicorn.workers.GeventWebSocketWorker -w 1 \
+#            --worker-connections 1000 -b 0.0.0.0:8000 app:app
+#   gunicorn -k gthread --threads 8 -w 1 -b 0.0.0.0:8000 app:app   (no gevent; Socket.IO long-polling only)
+# Run from backend/ (database.db is opened relative to the working directory).
+# Run exactly one worker/instance. Each extra one (-w 2, or another process on the port) would
+# need a Socket.IO message queue so emits reach every client, and sticky routing so polling sids
+# stay on one process; the replay/burst windows and emergency-check jobs are per-process too.
+
+# gevent must patch the stdlib before anything else imports socket/threading, so the
+# blocking AI-server round-trips in requests yield instead of stalling the worker.
+# Only when run directly (or BACKEND_GEVENT_PATCH=1): gunicorn's gevent worker patches before
+# loading the app, and patching inside an already-running gthread worker hangs it.
+import os
+if __name__ == '__main__' or os.environ.get("BACKEND_GEVENT_PATCH") == "1":
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        pass
+
+# Socket.IO must use the same concurrency model as the server: left on auto it picks gevent
+# whenever gevent is installed, and its emits never reach clients of an unpatched (gthread) worker.
+# Covers both our own patch above and the patch done by gunicorn's gevent worker.
+try:
+    from gevent import monkey as _gevent_monkey
+    SOCKETIO_ASYNC_MODE = "gevent" if _gevent_monkey.is_module_patched("socket") else "threading"
+except ImportError:
+    SOCKETIO_ASYNC_MODE = "threading"
+
+from flask import Flask, jsonify, request, g, has_app_context, Response
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 import sqlite3
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
 import time
 from datetime import datetime
 import random
 from flask_socketio import SocketIO
 import socket
-import hashlib
-import json
-from collections import deque, defaultdict
+import atexit
+import logging
+import threading
+import queue
+import uuid
+import functools
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# orjson for all (de)serialization: responses, AI request bodies and parsed replies
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+def orjson_response(obj, status=200):
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # Initialize SocketIO for real-time pushes
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=SOCKETIO_ASYNC_MODE)
+
+DB_PATH = 'database.db'
+
+# SQL kept as constants: sqlite3's statement cache is keyed on the exact text,
+# so every caller of the same constant reuses one prepared statement
+SQL_SELECT_DEVICES = 'SELECT id, name, type, data, threat, location, last_seen, power FROM devices'
+SQL_SELECT_CHECK_DEVICES = 'SELECT id, is_motion, data FROM devices'   # only what emergency_check reads
+SQL_SELECT_POWER = 'SELECT power FROM devices WHERE id = ?'
+SQL_INSERT_DEVICE = 'INSERT INTO devices (name, type, data, threat, location, last_seen, power, is_motion) VALUES (?,?,?,?,?,?,?,?)'
+SQL_UPDATE_POWER = 'UPDATE devices SET power = ? WHERE id = ?'
+SQL_UPDATE_THREAT = 'UPDATE devices SET threat = ? WHERE id = ?'
+SQL_UPDATE_DEVICE_STATE = 'UPDATE devices SET threat = ?, data = ?, last_seen = ? WHERE id = ?'
+SQL_DELETE_DEVICE = 'DELETE FROM devices WHERE id = ?'
+SQL_UPDATE_THREAT_CTE_MAX_ROWS = 400   # 2 bindings per row, under SQLite's old 999-variable limit
+DB_STATEMENT_CACHE = 256
+DB_POOL_SIZE = 16
+DB_MMAP_SIZE = 64 * 1024 * 1024   # bytes of the db file read via mmap
+DB_CACHE_SIZE = -20000            # negative = KiB, i.e. ~20 MB page cache per connection
 
 AI_SERVER_URL = "http://localhost:5000/predict"
+AI_BATCH_URL = "http://localhost:5000/batch_predict"
+# per-device fallback fan-out (only used when the AI server has no batch endpoint)
+AI_FANOUT_WORKERS = int(os.environ.get("AI_FANOUT_WORKERS", "16"))
+
+# One keep-alive session for all AI calls (reuses TCP connections instead of reconnecting per call).
+# pool_maxsize covers the fallback fan-out so parallel workers never drop a warm connection.
+AI_SESSION = requests.Session()
+_ai_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(64, AI_FANOUT_WORKERS), max_retries=0)
+AI_SESSION.mount('http://', _ai_adapter)
+AI_SESSION.mount('https://', _ai_adapter)
 
 # ---------- Replay / burst detection globals (minimal) ----------
-# per-device recent history: deque of (payload_hash, timestamp)
-_recent_payloads = defaultdict(lambda: deque(maxlen=1000))
+# per-device sliding window: device_id -> (deque of (payload_key, monotonic ts), Counter of keys in deque)
+_recent_payloads = {}
+_recent_lock = threading.Lock()
 
 # tuning params (tweak to match your environment)
 REPLAY_WINDOW_SEC = 5.0        # window to consider repeats
 REPLAY_REPEAT_THRESHOLD = 8    # same payload count within window => replay
 BURST_RATE_THRESHOLD = 20      # messages per second within window => burst/DoS
-
-# small helper to quantize values for hashing (makes heuristic robust to tiny noise)
-def _hash_payload_for_replay(p):
-    # Quantize temperature to 0.1 and humidity to integer percent for stable hashing
-    key_obj = {
-        "temperature": None if p.get("temperature") is None else round(float(p.get("temperature")), 1),
-        "humidity": None if p.get("humidity") is None else int(round(float(p.get("humidity")))),
-        "motion": int(p.get("motion", 0))
-    }
-    return hashlib.sha256(json.dumps(key_obj, sort_keys=True).encode()).hexdigest()
+REPLAY_MAX_PER_DEVICE = 1000   # hard cap on remembered payloads per device
+REPLAY_IDLE_SWEEP_SEC = 5 * REPLAY_WINDOW_SEC  # forget devices idle longer than this
+
+# small helper to quantize values into a replay key (makes heuristic robust to tiny noise)
+def _replay_key(p):
+    # Quantize temperature to 0.1 and humidity to integer percent; a tuple of small ints
+    # is hashable as-is, so it goes straight into the deque / Counter
+    temp = p.get("temperature")
+    hum = p.get("humidity")
+    temp_q = None if temp is None else int(round(float(temp) * 10))
+    hum_q = None if hum is None else int(round(float(hum)))
+    return (temp_q, hum_q, int(p.get("motion", 0)))
+
+def _record_payload(device_id, payload_key, now_ts):
+    """Add a payload to the device window; return (same_count, total_in_window)."""
+    cutoff = now_ts - REPLAY_WINDOW_SEC
+    with _recent_lock:
+        entry = _recent_payloads.get(device_id)
+        if entry is None:
+            entry = _recent_payloads[device_id] = (deque(), Counter())
+        dq, counts = entry
+        # evict from the old end so the window stays exact and each entry is dropped once
+        while dq and (dq[0][1] < cutoff or len(dq) >= REPLAY_MAX_PER_DEVICE):
+            old_key, _ = dq.popleft()
+            counts[old_key] -= 1
+            if not counts[old_key]:
+                del counts[old_key]
+        dq.append((payload_key, now_ts))
+        counts[payload_key] += 1
+        return counts[payload_key], len(dq)
+
+def _recent_payloads_sweep_loop():
+    while True:
+        time.sleep(REPLAY_IDLE_SWEEP_SEC)
+        cutoff = time.monotonic() - REPLAY_IDLE_SWEEP_SEC
+        with _recent_lock:
+            idle = [k for k, (dq, _) in _recent_payloads.items() if not dq or dq[-1][1] < cutoff]
+            for k in idle:
+                del _recent_payloads[k]
+
+threading.Thread(target=_recent_payloads_sweep_loop, daemon=True).start()
 
 # --- Socket.IO handlers & test endpoint ---
 @socketio.on('connect')
@@ -45,11 +160,11 @@ def handle_connect():
         sid = request.sid if hasattr(request, 'sid') else 'unknown'
     except Exception:
         sid = 'unknown'
-    print(f"Socket connected: sid={sid}")
+    logger.info("Socket connected: sid=%s", sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    print("Socket disconnected")
+    logger.info("Socket disconnected")
 
 @app.route('/api/test-emit', methods=['GET'])
 def test_emit():
@@ -60,246 +175,602 @@ def test_emit():
         "last_seen": "Just Now"
     }
     try:
-        print(f"[EMIT] about to emit device_update -> device_id={payload.get('device_id')}")
+        logger.debug("[EMIT] test_emit -> device_id=%s", payload.get('device_id'))
         socketio.emit('device_update', payload)
-        print("[EMIT] emit completed")
         return jsonify({"status": "emitted", "payload": payload})
     except Exception as e:
-        print("Error emitting test:", e)
+        logger.warning("Error emitting test: %s", e)
         return jsonify({"status": "error", "error": str(e)}), 500
 
 # --- Database Setup ---
 def init_db():
-    conn = sqlite3.connect('database.db')
+    conn = WRITER
+    # WAL lets readers run alongside the single writer; stored in the db file, so once is enough
+    conn.execute('PRAGMA journal_mode=WAL')
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS devices 
                  (id INTEGER PRIMARY KEY AUTOINCREMENT, 
                   name TEXT, type TEXT, data TEXT, 
                   threat TEXT, location TEXT, 
-                  last_seen TEXT, power BOOLEAN)''')
+                  last_seen TEXT, power BOOLEAN,
+                  is_motion INTEGER NOT NULL DEFAULT 0)''')
+
+    # Older databases predate is_motion: add it and derive it from the stored type
+    columns = {row[1] for row in c.execute('PRAGMA table_info(devices)')}
+    if 'is_motion' not in columns:
+        c.execute('ALTER TABLE devices ADD COLUMN is_motion INTEGER NOT NULL DEFAULT 0')
+        c.execute("UPDATE devices SET is_motion = (instr(type, 'Motion') > 0)")
     
     # Seed initial data if empty
     c.execute('SELECT count(*) FROM devices')
     if c.fetchone()[0] == 0:
         seed_data = [
-            ("DHT22 Sensor", "Temperature & Humidity", "24°C, 60%", "No Threat", "Living Room", "Now", 1),
-            ("PIR Motion", "Motion Detection", "Motion Detected", "No Threat", "Entrance", "Now", 1)
+            ("DHT22 Sensor", "Temperature & Humidity", "24°C, 60%", "No Threat", "Living Room", "Now", 1, 0),
+            ("PIR Motion", "Motion Detection", "Motion Detected", "No Threat", "Entrance", "Now", 1, 1)
         ]
-        c.executemany("INSERT INTO devices (name, type, data, threat, location, last_seen, power) VALUES (?,?,?,?,?,?,?)", seed_data)
-        conn.commit()
-    conn.close()
+        c.executemany(SQL_INSERT_DEVICE, seed_data)
+    conn.commit()
+    c.close()
 
-def get_db_connection():
-    conn = sqlite3.connect('database.db')
+def _is_motion_type(device_type):
+    # motion flag is derived once, when the device is stored, instead of on every check
+    return 1 if "Motion" in (device_type or "") else 0
+
+def _connect_db():
+    # check_same_thread=False: pooled connections are handed between worker threads/greenlets,
+    # but each one is only ever used by a single request at a time
+    conn = sqlite3.connect(DB_PATH, cached_statements=DB_STATEMENT_CACHE, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # per-connection tuning (journal_mode=WAL is persistent and set once in init_db):
+    # NORMAL sync is safe in WAL mode and skips the fsync per commit
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+    conn.execute(f'PRAGMA cache_size={DB_CACHE_SIZE}')
     return conn
 
+# requests borrow a warm (read) connection from this pool and hand it back on teardown;
+# background threads keep one long-lived connection each
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+_db_local = threading.local()
+
+def get_db_connection():
+    if has_app_context():
+        conn = g.get('db_conn')
+        if conn is None:
+            try:
+                conn = _db_pool.get_nowait()
+            except queue.Empty:
+                conn = _connect_db()
+            g.db_conn = conn
+        return conn
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = _db_local.conn = _connect_db()
+    return conn
+
+@app.teardown_appcontext
+def _release_db_connection(exc):
+    conn = g.pop('db_conn', None)
+    if conn is None:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _db_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+# All writes go through one long-lived connection behind a lock: SQLite allows a single
+# writer anyway, so this queues writers in-process instead of on SQLITE_BUSY retries.
+# Use as `with _writer_lock, WRITER:` - the connection context commits (or rolls back) on exit.
+WRITER = _connect_db()
+_writer_lock = threading.Lock()
+
+def _optimize_writer():
+    # SQLite recommends PRAGMA optimize before closing a long-lived connection
+    try:
+        with _writer_lock:
+            WRITER.execute('PRAGMA optimize')
+    except Exception as e:
+        logger.warning("PRAGMA optimize failed: %s", e)
+
+atexit.register(_optimize_writer)
+
+# at import so WSGI servers (which never run __main__) get the schema too
+with _writer_lock:
+    init_db()
+
+# --- /api/devices response cache ---
+# The dashboard polls the full device list every few seconds; keep the last encoded body and
+# reuse it until the table changes. Writers in this process bump the version *after* committing,
+# so a body built from pre-commit rows can never outlive the bump. Commits from other processes
+# (e.g. a script editing database.db) show up in PRAGMA data_version, read on a connection of its own
+# that never writes - the value is per-connection and only moves on other connections' commits.
+_devices_cache_lock = threading.Lock()
+_devices_version = 0
+_devices_cache = (-1, -1, None)   # (version, data_version it was built at, JSON bytes)
+_data_version_conn = _connect_db()
+_data_version_lock = threading.Lock()
+
+def _db_data_version():
+    with _data_version_lock:
+        return _data_version_conn.execute('PRAGMA data_version').fetchone()[0]
+
+def _invalidate_devices_cache():
+    global _devices_version
+    with _devices_cache_lock:
+        _devices_version += 1
+
+# --- Background DB writer ---
+# receive_external_data only enqueues its device UPDATE; this thread coalesces whatever
+# is queued into one executemany/commit and emits the UI updates once they are durable.
+_db_write_q = queue.Queue()
+DB_WRITE_BATCH_MAX = 512
+
+def _queue_device_update(device_id, threat_status, data_str):
+    payload_for_ui = {"device_id": device_id, "threat": threat_status, "data": data_str, "last_seen": "Just Now"}
+    _db_write_q.put_nowait(((threat_status, data_str, "Just Now", device_id), payload_for_ui))
+
+def db_writer_loop():
+    while True:
+        batch = []
+        try:
+            batch.append(_db_write_q.get(timeout=1.0))
+            while len(batch) < DB_WRITE_BATCH_MAX:
+                try:
+                    batch.append(_db_write_q.get_nowait())
+                except queue.Empty:
+                    break
+        except queue.Empty:
+            continue
+
+        try:
+            with _writer_lock, WRITER:
+                WRITER.executemany(SQL_UPDATE_DEVICE_STATE, [params for params, _ in batch])
+            _invalidate_devices_cache()
+        except Exception as e:
+            logger.warning("DB writer error: %s", e)
+            continue
+
+        for _, payload_for_ui in batch:
+            try:
+                logger.debug("[EMIT] device_update -> device_id=%s threat=%s data=%s",
+                             payload_for_ui['device_id'], payload_for_ui['threat'], payload_for_ui['data'])
+                socketio.emit('device_update', payload_for_ui)
+            except Exception as e:
+                logger.warning("Socket emit error (db writer): %s", e)
+
+threading.Thread(target=db_writer_loop, daemon=True).start()
+
 # --- API Routes ---
 
 @app.route('/api/devices', methods=['GET'])
 def get_devices():
+    global _devices_cache
+    with _devices_cache_lock:
+        version = _devices_version
+        cached_version, cached_data_version, body = _devices_cache
+    # read before the SELECT: a commit landing in between just makes the next GET rebuild
+    data_version = _db_data_version()
+    if cached_version == version and cached_data_version == data_version:
+        return Response(body, mimetype="application/json")
+
     conn = get_db_connection()
-    devices = conn.execute('SELECT * FROM devices').fetchall()
-    conn.close()
-    return jsonify([dict(row) for row in devices])
+    devices = conn.execute(SQL_SELECT_DEVICES).fetchall()
+    body = orjson.dumps([dict(row) for row in devices])
+    with _devices_cache_lock:
+        if _devices_version == version:
+            _devices_cache = (version, data_version, body)
+    return Response(body, mimetype="application/json")
 
 @app.route('/api/devices', methods=['POST'])
 def add_device():
     new_device = request.json
-    conn = get_db_connection()
-    conn.execute("INSERT INTO devices (name, type, data, threat, location, last_seen, power) VALUES (?,?,?,?,?,?,?)",
-                 (new_device['name'], new_device['type'], "N/A", "No Threat", "Unassigned", "Now", 1))
-    conn.commit()
-    conn.close()
+    with _writer_lock, WRITER:
+        WRITER.execute(SQL_INSERT_DEVICE,
+                       (new_device['name'], new_device['type'], "N/A", "No Threat", "Unassigned", "Now", 1,
+                        _is_motion_type(new_device['type'])))
+    _invalidate_devices_cache()
     return jsonify({"message": "Device added"}), 201
 
 @app.route('/api/devices/<int:id>/toggle', methods=['POST'])
 def toggle_device(id):
-    conn = get_db_connection()
-    device = conn.execute('SELECT power FROM devices WHERE id = ?', (id,)).fetchone()
+    # read and flip under the writer lock so two toggles can't both see the old state
+    with _writer_lock, WRITER:
+        device = WRITER.execute(SQL_SELECT_POWER, (id,)).fetchone()
+        if device:
+            WRITER.execute(SQL_UPDATE_POWER, (not device['power'], id))
     if device:
-        new_state = not device['power']
-        conn.execute('UPDATE devices SET power = ? WHERE id = ?', (new_state, id))
-        conn.commit()
-    conn.close()
+        _invalidate_devices_cache()
     return jsonify({"message": "Toggled"})
 
 @app.route('/api/devices/<int:id>', methods=['DELETE'])
 def delete_device(id):
-    conn = get_db_connection()
-    conn.execute('DELETE FROM devices WHERE id = ?', (id,))
-    conn.commit()
-    conn.close()
+    with _writer_lock, WRITER:
+        WRITER.execute(SQL_DELETE_DEVICE, (id,))
+    _invalidate_devices_cache()
     return jsonify({"message": "Deleted"})
 
 # --- AI Integration Logic ---
-@app.route('/api/emergency-check', methods=['POST'])
-def emergency_check():
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+AI_TIMEOUT = (1.0, 5.0)          # (connect, read) seconds
+AI_BREAKER_FAILURES = 5         # consecutive failures before the breaker opens
+AI_BREAKER_COOLDOWN_SEC = 30.0  # how long AI calls are skipped once open
+
+# circuit breaker: a stalled AI server must not pin request workers (and their DB connections)
+_ai_fail_count = 0
+_ai_open_until = 0.0
+_ai_breaker_lock = threading.Lock()
+
+class AIServerUnavailable(RuntimeError):
+    pass
+
+def _ai_post(url, payload):
+    global _ai_fail_count, _ai_open_until
+    if time.monotonic() < _ai_open_until:
+        raise AIServerUnavailable("AI server circuit open, skipping call")
+    error = None
+    response = None
+    try:
+        response = AI_SESSION.post(url, data=orjson.dumps(payload), headers=_JSON_HEADERS, timeout=AI_TIMEOUT)
+    except Exception as e:
+        error = e
+    failed = error is not None or response.status_code >= 500
+    with _ai_breaker_lock:
+        if not failed:
+            _ai_fail_count = 0
+        else:
+            _ai_fail_count += 1
+            if _ai_fail_count >= AI_BREAKER_FAILURES:
+                _ai_open_until = time.monotonic() + AI_BREAKER_COOLDOWN_SEC
+                _ai_fail_count = 0
+                logger.warning("AI server failing, circuit open for %.0fs", AI_BREAKER_COOLDOWN_SEC)
+    if error is not None:
+        raise error
+    return response
+
+@functools.lru_cache(maxsize=64)
+def _sql_update_threats(n):
+    # one UPDATE for n (id, threat) pairs; cached per n so the text (and the prepared statement) is reused
+    values = ','.join(['(?,?)'] * n)
+    return (f'WITH v(id, threat) AS (VALUES {values}) '
+            'UPDATE devices SET threat = (SELECT threat FROM v WHERE v.id = devices.id) '
+            'WHERE id IN (SELECT id FROM v)')
+
+def _threat_from_label(label):
+    predicted_label = str(label)
+    if predicted_label.lower() != 'normal' and predicted_label != '0':
+        return "Threat Detected"
+    return "No Threat"
+
+def _batch_unsupported(response):
+    # only a missing endpoint or a rejected payload shape; /batch_predict answers 400 for any
+    # model/scaler failure too, and per-device calls would just fail N more times
+    if response.status_code in (404, 405):
+        return True
+    if response.status_code != 400:
+        return False
+    try:
+        error = orjson.loads(response.content).get('error', '')
+    except Exception:
+        return False
+    return isinstance(error, str) and error.startswith('Unsupported payload')
+
+def _call_ai(features):
+    """Single-device AI call; returns the threat status, or None if the call failed."""
+    try:
+        response = _ai_post(AI_SERVER_URL, {"features": features})
+        if response.status_code == 200:
+            return _threat_from_label(orjson.loads(response.content).get('label', 'normal'))
+        logger.warning("AI Server Error for device %s: HTTP %s", features.get('device_id'), response.status_code)
+    except Exception as e:
+        logger.warning("AI Server Error for device %s: %s", features.get('device_id'), e)
+    return None
+
+# --- emergency_check prediction cache ---
+# (device_id, hour, temp rounded, humidity rounded, motion) -> threat status. Simulated readings
+# land in the same buckets often, and a hit skips the AI round-trip; the whole cache is dropped
+# every AI_PREDICTION_CACHE_TTL_SEC (and when full) so results can't drift for long.
+AI_PREDICTION_CACHE_MAX = 2048
+AI_PREDICTION_CACHE_TTL_SEC = 300.0
+_ai_pred_cache = {}
+_ai_pred_cache_lock = threading.Lock()
+
+def _ai_pred_cache_clear_loop():
+    while True:
+        time.sleep(AI_PREDICTION_CACHE_TTL_SEC)
+        with _ai_pred_cache_lock:
+            _ai_pred_cache.clear()
+
+threading.Thread(target=_ai_pred_cache_clear_loop, daemon=True).start()
+
+def run_emergency_check():
+    """Score every device with the AI server and store the threats; returns the result summary."""
     conn = get_db_connection()
-    devices = conn.execute('SELECT * FROM devices').fetchall()
+    devices = conn.execute(SQL_SELECT_CHECK_DEVICES).fetchall()
     
-    updated_count = 0
     current_time = datetime.now()
-
-    for dev in devices:
-        # Simulate Sensor Data 
-        sim_temp = random.uniform(20.0, 35.0)
-        sim_humidity = random.uniform(40.0, 90.0)
-        sim_motion = 1 if "Motion" in dev['type'] else 0
+    # loop-invariant: every device in this check shares the same timestamp
+    ts_str = current_time.strftime("%Y-%m-%dT%H:%M:%S")
+    hour, minute, second = current_time.hour, current_time.minute, current_time.second
+
+    # Simulate Sensor Data: draw every device's readings up front in two tight passes
+    n = len(devices)
+    uniform = random.uniform
+    sim_temps = [uniform(20.0, 35.0) for _ in range(n)]
+    sim_humidities = [uniform(40.0, 90.0) for _ in range(n)]
+
+    ids = []
+    features = []
+    cache_keys = []
+    for dev, sim_temp, sim_humidity in zip(devices, sim_temps, sim_humidities):
+        sim_motion = dev['is_motion']
         
-        ai_payload = {
-            "features": {
-                "device_id": str(dev['id']),
-                "timestamp": current_time.strftime("%Y-%m-%dT%H:%M:%S"),
-                "temperature": sim_temp,
-                "humidity": sim_humidity,
-                "motion": sim_motion,
-                "motion_detected": sim_motion,
-                "hour": current_time.hour,
-                "minute": current_time.minute,
-                "second": current_time.second
-            }
-        }
-
+        ids.append(dev['id'])
+        cache_keys.append((dev['id'], hour, round(sim_temp), round(sim_humidity), sim_motion))
+        features.append({
+            "device_id": str(dev['id']),
+            "timestamp": ts_str,
+            "temperature": sim_temp,
+            "humidity": sim_humidity,
+            "motion": sim_motion,
+            "motion_detected": sim_motion,
+            "hour": hour,
+            "minute": minute,
+            "second": second
+        })
+
+    # devices whose quantized reading was scored recently reuse that threat; only the rest go to the AI
+    with _ai_pred_cache_lock:
+        threats = [_ai_pred_cache.get(key) for key in cache_keys]
+    misses = [i for i, threat in enumerate(threats) if threat is None]
+    miss_features = [features[i] for i in misses]
+
+    # one batched AI call for every uncached device instead of one round-trip each;
+    # labels come back in the same order as `miss_features`
+    if miss_features:
         try:
-            response = requests.post(AI_SERVER_URL, json=ai_payload)
+            response = _ai_post(AI_BATCH_URL, {"features": miss_features})
             if response.status_code == 200:
-                result = response.json()
-                predicted_label = str(result.get('label', 'normal'))
-                
-                if predicted_label.lower() != 'normal' and predicted_label != '0':
-                    threat_status = "Threat Detected"
-                else:
-                    threat_status = "No Threat"
-                
-                conn.execute('UPDATE devices SET threat = ? WHERE id = ?', (threat_status, dev['id']))
-                updated_count += 1
-
-                # Emit update for frontend (real-time)
-                try:
-                    payload_for_ui = {
-                        "device_id": dev['id'],
-                        "threat": threat_status,
-                        "data": dev['data'],
-                        "last_seen": "Just Now"
-                    }
-                    print(f"[EMIT] emergency_check -> device_id={dev['id']} threat={threat_status}")
-                    socketio.emit('device_update', payload_for_ui)
-                    print("[EMIT] emergency_check emit completed")
-                except Exception as e:
-                    print("Socket emit error (emergency_check):", e)
+                labels = orjson.loads(response.content).get('labels', [])
+                for i, label in zip(misses, labels):
+                    threats[i] = _threat_from_label(label)
+            elif _batch_unsupported(response):
+                # AI server without (compact) batch support: per-device calls, in parallel
+                with ThreadPoolExecutor(max_workers=min(AI_FANOUT_WORKERS, len(miss_features))) as ex:
+                    for i, threat in zip(misses, ex.map(_call_ai, miss_features)):
+                        threats[i] = threat
+            else:
+                logger.warning("AI Server Error for batch of %d devices: HTTP %s", len(miss_features), response.status_code)
+        except Exception as e:
+            logger.warning("AI Server Error for batch of %d devices: %s", len(miss_features), e)
+
+        with _ai_pred_cache_lock:
+            if len(_ai_pred_cache) + len(misses) > AI_PREDICTION_CACHE_MAX:
+                _ai_pred_cache.clear()
+            for i in misses:
+                if threats[i] is not None:
+                    _ai_pred_cache[cache_keys[i]] = threats[i]
+
+    updates = [(threat, dev_id) for dev_id, threat in zip(ids, threats) if threat is not None]
+
+    if updates:
+        with _writer_lock, WRITER:
+            if len(updates) <= SQL_UPDATE_THREAT_CTE_MAX_ROWS:
+                WRITER.execute(_sql_update_threats(len(updates)),
+                               [v for threat, dev_id in updates for v in (dev_id, threat)])
+            else:
+                WRITER.executemany(SQL_UPDATE_THREAT, updates)
+        _invalidate_devices_cache()
+    updated_count = len(updates)
+
+    # Emit updates for frontend (real-time), after the commit so a refetch sees them
+    data_by_id = {dev['id']: dev['data'] for dev in devices}
+    for threat_status, dev_id in updates:
+        try:
+            payload_for_ui = {
+                "device_id": dev_id,
+                "threat": threat_status,
+                "data": data_by_id[dev_id],
+                "last_seen": "Just Now"
+            }
+            logger.debug("[EMIT] emergency_check -> device_id=%s threat=%s", dev_id, threat_status)
+            socketio.emit('device_update', payload_for_ui)
+        except Exception as e:
+            logger.warning("Socket emit error (emergency_check): %s", e)
+
+    return {"message": "Check complete", "devices_checked": updated_count}
+
+# --- Emergency check jobs ---
+# A full check is N devices of AI round-trips, so the route only enqueues it and returns 202;
+# a single worker runs the checks one at a time and the client polls the job by id.
+# Clicks while a check is queued or running get that job's id back, so at most one is pending.
+# The registry lives in this process only, which is one reason the backend must run as a single
+# instance (see the header); a poll that reaches another process - or this one after a restart -
+# gets a 404, which the dashboard reports as a failed check.
+_emergency_q = queue.Queue()
+_emergency_jobs = {}              # job_id -> {"job_id", "status", ...result}
+_emergency_jobs_lock = threading.Lock()
+_emergency_active_id = None       # queued/running job, if any
+EMERGENCY_JOBS_KEEP = 100         # finished jobs remembered for polling
+
+def emergency_worker_loop():
+    global _emergency_active_id
+    while True:
+        job_id = _emergency_q.get()
+        with _emergency_jobs_lock:
+            _emergency_jobs[job_id]["status"] = "running"
+        try:
+            result = run_emergency_check()
+            update = {"status": "done", **result}
+        except Exception as e:
+            logger.warning("Emergency check %s failed: %s", job_id, e)
+            update = {"status": "error", "error": str(e)}
+        with _emergency_jobs_lock:
+            _emergency_jobs[job_id].update(update)
+            if _emergency_active_id == job_id:
+                _emergency_active_id = None
+            # dicts keep insertion order, so the oldest jobs are dropped first
+            finished = [k for k, job in _emergency_jobs.items() if job["status"] in ("done", "error")]
+            for k in finished[:max(0, len(finished) - EMERGENCY_JOBS_KEEP)]:
+                del _emergency_jobs[k]
+
+threading.Thread(target=emergency_worker_loop, daemon=True).start()
+
+@app.route('/api/emergency-check', methods=['POST'])
+def emergency_check():
+    global _emergency_active_id
+    with _emergency_jobs_lock:
+        job_id = _emergency_active_id
+        if job_id is None:
+            job_id = _emergency_active_id = uuid.uuid4().hex
+            _emergency_jobs[job_id] = {"job_id": job_id, "status": "queued"}
+            _emergency_q.put_nowait(job_id)
+        body = dict(_emergency_jobs[job_id])
+    response = orjson_response(body, 202)
+    response.headers['Location'] = f"/api/emergency-check/{job_id}"
+    return response
+
+@app.route('/api/emergency-check/<job_id>', methods=['GET'])
+def emergency_check_status(job_id):
+    with _emergency_jobs_lock:
+        job = _emergency_jobs.get(job_id)
+        body = dict(job) if job is not None else None
+    if body is None:
+        return orjson_response({"error": "job not found"}, 404)
+    return orjson_response(body)
+
+# --- Adaptive batching for /api/external-data ---
+# Requests park their AI features in a shared buffer and wait; one flusher thread sends
+# whatever accumulated (up to EXT_BATCH_MAX, or after EXT_BATCH_WINDOW_SEC) as a single
+# /batch_predict call. While a batch is in flight new arrivals pile up, so batches grow
+# with load and a lone request only pays the short window.
+EXT_BATCH_MAX = 64
+EXT_BATCH_WINDOW_SEC = 0.005
+EXT_BATCH_WAIT_SEC = AI_TIMEOUT[0] + AI_TIMEOUT[1] + 1.0   # caller gives up after this
+
+_ext_buffer = []                  # [features, threading.Event, result] per waiting request
+_ext_cv = threading.Condition()
+
+def _predict_buffered(features):
+    """Queue one device's features for the next AI batch and wait for its result dict."""
+    item = [features, threading.Event(), None]
+    with _ext_cv:
+        _ext_buffer.append(item)
+        _ext_cv.notify()
+    if not item[1].wait(EXT_BATCH_WAIT_SEC):
+        # drop it if it hasn't been sent yet, so the AI server never scores a reading
+        # whose caller already answered "unknown"
+        with _ext_cv:
+            for i, queued in enumerate(_ext_buffer):
+                if queued is item:
+                    del _ext_buffer[i]
+                    break
+        return {"label": "unknown", "error": "AI batch timed out"}
+    return item[2]
+
+def ext_batch_flusher_loop():
+    while True:
+        with _ext_cv:
+            while not _ext_buffer:
+                _ext_cv.wait()
+            deadline = time.monotonic() + EXT_BATCH_WINDOW_SEC
+            while len(_ext_buffer) < EXT_BATCH_MAX:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                _ext_cv.wait(remaining)
+            batch = _ext_buffer[:EXT_BATCH_MAX]
+            del _ext_buffer[:EXT_BATCH_MAX]
+        # callers that timed out while we waited may have emptied the buffer
+        if not batch:
+            continue
 
+        try:
+            # list form: one {"input", "result"} per row, result shaped like a /predict reply
+            ai_resp = _ai_post(AI_BATCH_URL, [{"features": features} for features, _, _ in batch])
+            if ai_resp.status_code == 200:
+                predictions = orjson.loads(ai_resp.content).get('predictions', [])
+                results = [pred.get('result', {"label": "unknown"}) for pred in predictions]
+            else:
+                results = [{"label": "unknown", "raw_status": ai_resp.status_code}] * len(batch)
         except Exception as e:
-            print(f"AI Server Error for device {dev['id']}: {e}")
+            results = [{"label": "unknown", "error": str(e)}] * len(batch)
 
-    conn.commit()
-    conn.close()
-    return jsonify({"message": "Check complete", "devices_checked": updated_count})
+        if len(results) < len(batch):
+            results = results + [{"label": "unknown"}] * (len(batch) - len(results))
+        for item, result in zip(batch, results):
+            item[2] = result
+            item[1].set()
+
+threading.Thread(target=ext_batch_flusher_loop, daemon=True).start()
 
 # To receive external data sent by the AI server 
 @app.route('/api/external-data', methods=['POST'])
 def receive_external_data():
     """
     Accept sensor JSON from external clients, check DB power state,
-    forward to AI server at AI_SERVER_URL, update DB, return status.
+    score it with the AI server (batched with concurrent requests), update DB, return status.
     """
     conn = get_db_connection()
-    payload = request.get_json(force=True, silent=True)
+    try:
+        payload = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        payload = None
 
     # (debug prints removed)
     if not payload:
-        conn.close()
-        return jsonify({"error": "no json payload"}), 400
+        return orjson_response({"error": "no json payload"}, 400)
 
     device_id = payload.get('device_id')
     if device_id is None:
-        conn.close()
-        return jsonify({"error": "missing device_id"}), 400
+        return orjson_response({"error": "missing device_id"}, 400)
 
-    device = conn.execute('SELECT * FROM devices WHERE id = ?', (device_id,)).fetchone()
+    # only the power flag is needed here; the reading itself comes from the payload
+    device = conn.execute(SQL_SELECT_POWER, (device_id,)).fetchone()
     if not device:
-        conn.close()
-        return jsonify({"error": "device not found"}), 404
+        return orjson_response({"error": "device not found"}, 404)
 
     if not device['power']:
-        conn.close()
-        return jsonify({"status": "ignored", "message": "Device is turned OFF"}), 200
+        return orjson_response({"status": "ignored", "message": "Device is turned OFF"}, 200)
 
     # -------------------------
     # QUICK REPLAY / BURST HEURISTIC
     # -------------------------
     try:
-        now_ts = time.time()
-        payload_hash = _hash_payload_for_replay(payload)
-
-        dq = _recent_payloads[device_id]
-        dq.append((payload_hash, now_ts))
-
-        cutoff = now_ts - REPLAY_WINDOW_SEC
-        same_count = 0
-        total_in_window = 0
-        for h, ts in reversed(dq):
-            if ts < cutoff:
-                break
-            total_in_window += 1
-            if h == payload_hash:
-                same_count += 1
-
-        # replay detection: identical payload repeated many times within window
-        if same_count >= REPLAY_REPEAT_THRESHOLD:
-            threat_status = "Threat Detected"
-            data_str = f"{payload.get('temperature')}°C, {payload.get('humidity')}%"
-            conn.execute('UPDATE devices SET threat = ?, data = ?, last_seen = ? WHERE id = ?',
-                         (threat_status, data_str, "Just Now", device_id))
-            conn.commit()
-
-            try:
-                payload_for_ui = {"device_id": device_id, "threat": threat_status, "data": data_str, "last_seen": "Just Now"}
-                socketio.emit('device_update', payload_for_ui)
-            except Exception as e:
-                print("Socket emit error (replay heuristic):", e)
+        payload_key = _replay_key(payload)
+        same_count, total_in_window = _record_payload(device_id, payload_key, time.monotonic())
 
-            return jsonify({"status": "processed", "threat": threat_status, "ai": {"label": "replay_detected"}})
+        # replay: identical payload repeated many times within window;
+        # burst: high messages/sec within window (replay wins if both trip)
+        if same_count >= REPLAY_REPEAT_THRESHOLD:
+            reason = "replay"
+        elif (total_in_window / max(1.0, REPLAY_WINDOW_SEC)) >= BURST_RATE_THRESHOLD:
+            reason = "burst"
+        else:
+            reason = None
 
-        # burst-rate detection (high messages/sec)
-        if (total_in_window / max(1.0, REPLAY_WINDOW_SEC)) >= BURST_RATE_THRESHOLD:
+        if reason is not None:
             threat_status = "Threat Detected"
             data_str = f"{payload.get('temperature')}°C, {payload.get('humidity')}%"
-            conn.execute('UPDATE devices SET threat = ?, data = ?, last_seen = ? WHERE id = ?',
-                         (threat_status, data_str, "Just Now", device_id))
-            conn.commit()
-
-            try:
-                payload_for_ui = {"device_id": device_id, "threat": threat_status, "data": data_str, "last_seen": "Just Now"}
-                socketio.emit('device_update', payload_for_ui)
-            except Exception as e:
-                print("Socket emit error (burst heuristic):", e)
+            _queue_device_update(device_id, threat_status, data_str)
 
-            return jsonify({"status": "processed", "threat": threat_status, "ai": {"label": "burst_detected"}})
+            return orjson_response({"status": "processed", "threat": threat_status, "ai": {"label": f"{reason}_detected"}})
 
     except Exception as e:
-        print("Replay heuristic error:", e)
+        logger.warning("Replay heuristic error: %s", e)
         # continue to AI processing path if heuristic fails
 
     ts = payload.get('timestamp') or datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-    ai_payload = {
-        "features": {
-            "device_id": str(device_id),
-            "timestamp": ts,
-            "temperature": payload.get('temperature'),
-            "humidity": payload.get('humidity'),
-            "motion": payload.get('motion', 0)
-        }
-    }
-
-    try:
-        ai_resp = requests.post(AI_SERVER_URL, json=ai_payload, timeout=10)
-        if ai_resp.status_code == 200:
-            ai_result = ai_resp.json()
-        else:
-            ai_result = {"label": "unknown", "raw_status": ai_resp.status_code}
-    except Exception as e:
-        ai_result = {"label": "unknown", "error": str(e)}
+    ai_result = _predict_buffered({
+        "device_id": str(device_id),
+        "timestamp": ts,
+        "temperature": payload.get('temperature'),
+        "humidity": payload.get('humidity'),
+        "motion": payload.get('motion', 0)
+    })
 
     # >>> SAFE LABEL LOGIC <<<
     label = str(ai_result.get('label', 'unknown'))
@@ -316,26 +787,10 @@ def receive_external_data():
         threat_status = "Threat Detected"
 
     data_str = f"{payload.get('temperature')}°C, {payload.get('humidity')}%"
-    conn.execute('UPDATE devices SET threat = ?, data = ?, last_seen = ? WHERE id = ?',
-                 (threat_status, data_str, "Just Now", device_id))
-    conn.commit()
-    conn.close()
-
-    # Emit the update after DB commit so frontend gets the latest info
-    try:
-        payload_for_ui = {
-            "device_id": device_id,
-            "threat": threat_status,
-            "data": data_str,
-            "last_seen": "Just Now"
-        }
-        print(f"[EMIT] receive_external_data -> device_id={device_id} threat={threat_status} data={data_str}")
-        socketio.emit('device_update', payload_for_ui)
-        print("[EMIT] receive_external_data emit completed")
-    except Exception as e:
-        print("Socket emit error (receive_external_data):", e)
+    # DB update + socket emit happen on the background writer
+    _queue_device_update(device_id, threat_status, data_str)
 
-    return jsonify({"status": "processed", "threat": threat_status, "ai": ai_result})
+    return orjson_response({"status": "processed", "threat": threat_status, "ai": ai_result})
 
 # Helper to determine local LAN IP for prettier startup banner
 def get_local_ip():
@@ -352,9 +807,9 @@ def get_local_ip():
 
 # --- THIS IS THE CRITICAL PART ---
 if __name__ == '__main__':
-    init_db()
+    logging.basicConfig(level=logging.WARNING)
     local_ip = get_local_ip()
     print("Main Backend running on Port 8000...")
     print(f" * Local Access:   http://127.0.0.1:8000")
     print(f" * Network Access: http://{local_ip}:8000")
-    socketio.run(app, host="0.0.0.0", port=8000, debug=True)
+    socketio.run(app, host="0.0.0.0", port=8000, debug=False)
@@ -111,7 +111,17 @@ if(emergencyBtn) {
 
       try {
         const res = await fetch(`${API_URL}/emergency-check`, { method: "POST" });
-        const data = await res.json();
+        let data = await res.json();
+        // the check runs in the background (202 + job id); poll until it finishes
+        if (!res.ok) throw new Error(data.error || `HTTP ${res.status}`);
+        while (res.status === 202 && (data.status === "queued" || data.status === "running")) {
+          await new Promise(resolve => setTimeout(resolve, 500));
+          const statusRes = await fetch(`${API_URL}/emergency-check/${data.job_id}`);
+          data = await statusRes.json();
+          // e.g. 404 once the job was pruned or the server restarted
+          if (!statusRes.ok) throw new Error(data.error || `HTTP ${statusRes.status}`);
+        }
+        if (data.status === "error") throw new Error(data.error);
         alert(data.message + ` (${data.devices_checked} devices scanned)`);
         fetchAndRender(); // Refresh UI to show new threat statuses
       } catch (e) {